@@ -1,10 +1,18 @@
+from functools import lru_cache
+
+
 def buildInsertQuery(table, keys):
     '''
     Build an insert query with dictionary-type placeholders for the given keys.
     '''
+    return _buildInsertQuery(table, tuple(keys))
+
 
-    return 'INSERT INTO ' + table +' (' + ','.join(keys) + \
-            ') VALUES(%(' + ')s,%('.join(keys) + ')s)'
+@lru_cache(maxsize=256)
+def _buildInsertQuery(table, keys):
+    columns = ','.join(keys)
+    placeholders = ','.join(f'%({key})s' for key in keys)
+    return f'INSERT INTO {table} ({columns}) VALUES({placeholders})'
 
 
 def whereEquals(equalConditions, coordinator='AND'):
@@ -12,10 +20,27 @@ def whereEquals(equalConditions, coordinator='AND'):
     Build a WHERE clause with dictionary-type placeholders where all
     conditions are "equals" and the coordinating conjunction is the same.
     '''
-    coordinator = coordinator + ' '
-    return coordinator.join(
-            [key + ' = %(' + key + ')s ' for key in equalConditions])
+    return _whereEquals(tuple(equalConditions), coordinator)
 
 
-def makePlaceholderList(sourceList):
-    return ','.join(['%s'] * len(sourceList)) or '""'
+@lru_cache(maxsize=256)
+def _whereEquals(keys, coordinator):
+    return f'{coordinator} '.join(f'{key} = %({key})s ' for key in keys)
+
+
+def makePlaceholderList(count):
+    '''
+    Build a comma-separated list of count positional placeholders. A
+    sequence may be passed instead of its length.
+    '''
+    if not isinstance(count, int):
+        count = len(count)
+    return ','.join(['%s'] * count) or '""'
+
+
+@lru_cache(maxsize=1024)
+def quoteIdentifier(name):
+    '''
+    Quote a table, column or database name for use in a query.
+    '''
+    return '`' + name.replace('`', '``') + '`'
@@ -1,13 +1,16 @@
-from functools import partial
+from functools import partial, lru_cache
+from itertools import groupby, islice
 import os
-import json
 import logging
-from contextlib import closing
+from contextlib import closing, contextmanager, nullcontext
 import importlib
 import tempfile
 import time
 import subprocess
 import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import multiprocessing
 from datetime import datetime
 from io import StringIO
@@ -19,8 +22,18 @@ from argh import CommandError
 from Coronado.Plugin import AppPlugin as AppPluginBase, \
         CommandLinePlugin as CLPluginBase
 import pymysql
-from pymysql.cursors import DictCursor
+from pymysql.constants import CLIENT
+from pymysql.cursors import Cursor, DictCursor, SSDictCursor
 import boto3
+import ijson
+from dbutils.pooled_db import PooledDB
+try:
+    # orjson is optional but parses considerably faster
+    from orjson import loads as loadJson
+except ImportError:
+    from json import loads as loadJson
+
+from .Util import makePlaceholderList, quoteIdentifier
 
 logger = logging.getLogger(__name__)
 
@@ -36,31 +49,551 @@ config = \
     'connRetryIntervalSecs': 5,
     'mysqlBackupIntervalSecs': 0,
     'mysqlBackupS3BucketName': None,
-    'mysqlBackupS3KeyPrefix': ''
+    'mysqlBackupS3KeyPrefix': '',
+    'mysqlPoolMinCached': 1,
+    'mysqlPoolMaxCached': 8,
+    'mysqlPoolMaxConnections': 16
 }
 
-def getMysqlConnection(context):
-    # Connect to MySQL
-    database = pymysql.connect(host=context['mysqlHost'],
-        user=context['mysqlUser'], passwd=context['mysqlPassword'],
-        db=context['mysqlDbName'], use_unicode=True, charset='utf8',
-        cursorclass=DictCursor)
-
-    # Turn on autocommit
-    database.autocommit(True)
-
-    # Set wait_timeout to its largest value (365 days): connection will be
-    # disconnected only if it is idle for 365 days.
+# Data files at least this large are streamed instead of loaded whole
+JSON_STREAMING_THRESHOLD = 10 * 1024 * 1024
+
+# Characters of SQL buffered before a script batch is sent at the next
+# statement boundary; keeps batches well under max_allowed_packet
+SQL_BATCH_SIZE = 512 * 1024
+
+# Default rows per statement and transaction when importing data
+IMPORT_CHUNK_SIZE = 10000
+
+# Chunks between progress messages when importing data
+PROGRESS_LOG_INTERVAL = 10
+
+# Session bulk insert buffer size while importing data
+BULK_INSERT_BUFFER_SIZE = 256 * 1024 * 1024
+
+# Guards creation of connection pools
+POOL_LOCK = threading.Lock()
+
+# Valid answers to askYesOrNoQuestion()
+YES_OR_NO = frozenset(('y', 'n'))
+
+# Escapes for fields in LOAD DATA files
+TSV_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n',
+    '\r': '\\r', '\0': '\\0'})
+
+def getMysqlConnectArgs(context, **overrides):
+    '''
+    Get keyword arguments for pymysql.connect() from the context, with any
+    given overrides applied.
+    '''
+    args = dict(host=context['mysqlHost'], user=context['mysqlUser'],
+        passwd=context['mysqlPassword'], db=context['mysqlDbName'],
+        use_unicode=True, charset='utf8', cursorclass=DictCursor,
+        # Set wait_timeout to its largest value (365 days): connection will
+        # be disconnected only if it is idle for 365 days.
+        init_command='SET wait_timeout=31536000',
+        # Only sent to the server if its default differs
+        autocommit=True)
+    args.update(overrides)
+    return args
+
+
+def getMysqlConnection(context, cursorclass=DictCursor):
+    '''
+    Get a connection from the context's MySQL connection pool for the given
+    cursor class. Closing the connection returns it to the pool.
+
+    The connection is a DBUtils wrapper that only supports the DB-API
+    methods, so connections handed to application code should come from
+    pymysql.connect() instead.
+    '''
+    # Import workers ask for connections concurrently, so create each pool
+    # only once or maxconnections would not hold
+    with POOL_LOCK:
+        pools = context.setdefault('_mysqlPools', {})
+        pool = pools.get(cursorclass)
+        if pool is None:
+            # Connect to MySQL. Pings are disabled because wait_timeout is
+            # long and the pool reconnects on failures anyway.
+            pool = PooledDB(pymysql, mincached=context['mysqlPoolMinCached'],
+                maxcached=context['mysqlPoolMaxCached'],
+                maxconnections=context['mysqlPoolMaxConnections'],
+                blocking=True, ping=0,
+                **getMysqlConnectArgs(context, cursorclass=cursorclass))
+            pools[cursorclass] = pool
+
+    return pool.connection()
+
+
+def getStreamingConnection(context):
+    '''
+    Get a connection whose cursors leave result sets on the server and
+    stream rows on demand, for reading large tables.
+
+    Each result set must be fully read (e.g. with batchedFetch) before the
+    connection is used for another query. The caller closes the connection.
+    '''
+    return pymysql.connect(**getMysqlConnectArgs(context,
+            cursorclass=SSDictCursor))
+
+
+def batchedFetch(cursor, size=1000):
+    '''
+    Iterate over a cursor's remaining rows, fetching them in batches.
+    '''
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield from rows
+
+
+def iterDataFileTables(jsonDataFilePath):
+    '''
+    Iterate over the tables in a JSON data file. Large files are parsed
+    incrementally, with each table's rows streamed from the file; those
+    rows must be consumed before moving on to the next table.
+    '''
+    with open(jsonDataFilePath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < JSON_STREAMING_THRESHOLD:
+            yield from loadJson(f.read())
+        else:
+            events = ijson.parse(f)
+            for prefix, event, _ in events:
+                if prefix == 'item' and event == 'start_map':
+                    yield from iterJsonTable(events)
+
+
+def iterJsonTable(events):
+    '''
+    Build a table object from ijson events following its start_map and
+    yield it. If the table's name precedes its rows, the rows are yielded
+    as a lazy iterator over the events instead of a list.
+    '''
+    table = {}
+    streamed = False
+    for _, event, key in events:
+        if event == 'end_map':
+            break
+
+        _, event, value = next(events)
+        if key == 'rows' and event == 'start_array' and 'name' in table:
+            table['rows'] = iterJsonArray(events)
+            yield table
+            streamed = True
+
+            # Skip any rows the caller did not consume
+            for _ in table['rows']:
+                pass
+        else:
+            table[key] = buildJsonValue(event, value, events)
+
+    if not streamed:
+        yield table
+
+
+def iterJsonArray(events):
+    '''
+    Iterate over the items of a JSON array, given ijson events following
+    its start_array.
+    '''
+    for _, event, value in events:
+        if event == 'end_array':
+            return
+        yield buildJsonValue(event, value, events)
+
+
+def buildJsonValue(event, value, events):
+    '''
+    Build a JSON value from its first ijson event and the events after it.
+    '''
+    builder = ijson.ObjectBuilder()
+    depth = 0
+    while True:
+        builder.event(event, value)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+        if depth == 0:
+            return builder.value
+        _, event, value = next(events)
+
+
+def scanSqlLine(line, delimiter, quote=None):
+    '''
+    Scan a line of a SQL script for statement delimiters, skipping string
+    literals, quoted identifiers and comments. quote is the literal or block
+    comment left open by the previous line, if any.
+
+    Returns the literal or block comment left open by this line, the offsets
+    just after each delimiter, and the offset just after the last character
+    that is not whitespace or part of a comment.
+    '''
+    ends = []
+    codeEnd = 0
+    i = 0
+    while i < len(line):
+        if quote in ('/*', '/*!'):
+            close = line.find('*/', i)
+            if close < 0:
+                break
+            i = close + 2
+            # Executable comments (/*! ... */) are code to MySQL
+            if quote == '/*!':
+                codeEnd = i
+            quote = None
+        elif quote:
+            if line[i] == '\\' and quote != '`':
+                i += 1
+            elif line[i] == quote:
+                quote = None
+            i += 1
+            codeEnd = min(i, len(line))
+        elif line.startswith(delimiter, i):
+            i += len(delimiter)
+            ends.append(i)
+            codeEnd = i
+        elif line[i] == '#' or (line.startswith('--', i) and
+                not line[i + 2:i + 3].strip()):
+            break
+        elif line.startswith('/*', i):
+            quote = '/*!' if line.startswith(('/*!', '/*+'), i) else '/*'
+            i += 2
+        else:
+            if line[i] in '\'"`':
+                quote = line[i]
+            if not line[i].isspace():
+                codeEnd = i + 1
+            i += 1
+
+    return quote, ends, codeEnd
+
+
+def iterSqlScriptBatches(lines, batchSize=SQL_BATCH_SIZE):
+    '''
+    Split the lines of a SQL script into batches that can be sent to a
+    connection with multiple statements enabled. Statements are grouped
+    until a batch reaches about batchSize characters. Handles the mysql
+    client's DELIMITER directive: statements ending in a custom delimiter
+    are sent one at a time, without the delimiter.
+    '''
+    delimiter = ';'
+    quote = None
+    buffered = []
+    size = 0
+    # Characters buffered up to the end of the last complete statement, and
+    # whether another statement has been started since
+    complete = 0
+    pending = False
+
+    def flush():
+        nonlocal size, complete
+        batch = ''.join(buffered)
+        # Leave out comments after the last statement: the server rejects a
+        # statement that is only a comment
+        if not pending:
+            batch = batch[:complete]
+        buffered.clear()
+        size = complete = 0
+        return batch.strip()
+
+    for line in lines:
+        # Like the mysql client, only accept DELIMITER before a statement
+        words = line.split(None, 1)
+        if quote is None and not pending and len(words) == 2 and \
+                words[0].upper() == 'DELIMITER':
+            batch = flush()
+            if batch:
+                yield batch
+            delimiter = words[1].strip()
+            continue
+
+        quote, ends, codeEnd = scanSqlLine(line, delimiter, quote)
+
+        if ends and delimiter != ';':
+            # Send each statement on its own, without the delimiter, and
+            # keep the rest of the line for the next one
+            start = 0
+            for end in ends:
+                buffered.append(line[start:end - len(delimiter)])
+                size += len(buffered[-1])
+                complete = size
+                batch = flush()
+                if batch:
+                    yield batch
+                start = end
+            line = line[start:]
+            codeEnd -= start
+            ends = []
+            pending = False
+
+        if ends:
+            complete = size + ends[-1]
+            pending = codeEnd > ends[-1]
+        elif codeEnd:
+            pending = True
+        buffered.append(line)
+        size += len(line)
+
+        # Only split between statements, never inside a literal or comment
+        if delimiter == ';' and quote is None and not pending and \
+                size >= batchSize:
+            batch = flush()
+            if batch:
+                yield batch
+
+    batch = flush()
+    if batch:
+        yield batch
+
+
+def executeSqlScript(database, sql):
+    '''
+    Execute a SQL script on a connection that has multiple statements
+    enabled. The script may be a string or an iterable of lines such as an
+    open file.
+    '''
+    if isinstance(sql, str):
+        sql = sql.splitlines(keepends=True)
     with closing(database.cursor()) as cursor:
-        cursor.execute("SET wait_timeout=31536000")
+        for batch in iterSqlScriptBatches(sql):
+            cursor.execute(batch)
+            # Consume remaining results so errors in later statements
+            # surface here
+            while cursor.nextset():
+                pass
+
+
+def iterRowChunks(tableName, rows, chunkSize=IMPORT_CHUNK_SIZE):
+    '''
+    Split rows (dicts) into chunks of at most chunkSize consecutive rows
+    with the same columns. Yields (columns, chunk) pairs where each chunk
+    holds the rows' values in column order. Progress is logged every
+    PROGRESS_LOG_INTERVAL chunks.
+    '''
+    done = 0
+    chunks = 0
+    for columns, group in groupby(rows, key=lambda row: tuple(sorted(row))):
+        while True:
+            chunk = [tuple(row[column] for column in columns)
+                    for row in islice(group, chunkSize)]
+            if not chunk:
+                break
+
+            yield columns, chunk
+
+            done += len(chunk)
+            chunks += 1
+            if chunks % PROGRESS_LOG_INTERVAL == 0:
+                logger.info('Inserted %d rows into %s', done, tableName)
+
+
+def quoteColumns(columns):
+    '''
+    Quote a tuple of column names as a comma-separated list.
+    '''
+    return ','.join(quoteIdentifier(column) for column in columns)
+
+
+def insertRows(db, cursor, tableName, rows, ignoreConflicts=False,
+        chunkSize=IMPORT_CHUNK_SIZE):
+    '''
+    Insert rows (dicts) into a table using multi-row INSERT statements, one
+    statement and transaction per chunk of rows. With ignoreConflicts, rows
+    with duplicate keys are skipped.
+    '''
+    insert = 'INSERT INTO ' + quoteIdentifier(tableName)
+    queryColumns = query = None
+    for columns, chunk in iterRowChunks(tableName, rows, chunkSize):
+        # Build the query once per set of columns; executemany() rewrites it
+        # into a multi-row INSERT
+        if columns != queryColumns:
+            query = insert + ' (' + quoteColumns(columns) + \
+                    ') VALUES (' + makePlaceholderList(len(columns)) + ')'
+
+            # Unlike INSERT IGNORE, a no-op update only ignores key
+            # conflicts; other bad values still fail the insert
+            if ignoreConflicts and columns:
+                column = quoteIdentifier(columns[0])
+                query += ' ON DUPLICATE KEY UPDATE ' + column + ' = ' + column
+            queryColumns = columns
+
+        db.begin()
+        try:
+            cursor.executemany(query, chunk)
+        except:
+            db.rollback()
+            raise
+        else:
+            db.commit()
+
+
+def formatTsvField(value):
+    '''
+    Format a value as a field of a LOAD DATA file with the default field
+    and line terminators and escape character.
+    '''
+    if value is None:
+        return '\\N'
+    elif value is True:
+        return '1'
+    elif value is False:
+        return '0'
+    return str(value).translate(TSV_ESCAPES)
+
+
+def loadRows(db, cursor, tableName, rows, ignoreConflicts=False,
+        chunkSize=IMPORT_CHUNK_SIZE):
+    '''
+    Insert rows (dicts) into a table using LOAD DATA LOCAL INFILE. Each
+    chunk of rows is written to a temporary tab-separated file and loaded
+    in one statement and transaction. The connection must allow local
+    infile.
+    '''
+    load = 'LOAD DATA LOCAL INFILE %s ' + \
+            ('IGNORE ' if ignoreConflicts else '') + 'INTO TABLE ' + \
+            quoteIdentifier(tableName) + ' CHARACTER SET utf8mb4 ('
+    for columns, chunk in iterRowChunks(tableName, rows, chunkSize):
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8',
+                newline='\n', suffix='.tsv') as f:
+            for values in chunk:
+                f.write('\t'.join(formatTsvField(value) for value in values)
+                        + '\n')
+            f.flush()
+
+            db.begin()
+            try:
+                loaded = cursor.execute(load + quoteColumns(columns) + ')',
+                        (f.name,))
+
+                # With LOCAL the server skips duplicate keys instead of
+                # failing, so detect them here
+                if loaded < len(chunk) and not ignoreConflicts:
+                    raise pymysql.IntegrityError(1062, 'Skipped ' +
+                            str(len(chunk) - loaded) + ' conflicting rows ' +
+                            'while loading table ' + tableName)
+            except:
+                db.rollback()
+                raise
+            else:
+                db.commit()
+
+
+@contextmanager
+def bulkLoadSession(cursor, uniqueChecks=True):
+    '''
+    Relax per-row checks in the cursor's session for a bulk load and
+    restore the previous settings afterwards.
+    '''
+    cursor.execute('SELECT @@foreign_key_checks AS foreignKeyChecks, '
+            '@@unique_checks AS uniqueChecks, '
+            '@@bulk_insert_buffer_size AS bulkInsertBufferSize')
+    previous = cursor.fetchone()
+
+    cursor.execute('SET SESSION foreign_key_checks = 0, unique_checks = %s, '
+            'bulk_insert_buffer_size = %s',
+            (int(uniqueChecks), BULK_INSERT_BUFFER_SIZE))
+    try:
+        yield
+    finally:
+        cursor.execute('SET SESSION foreign_key_checks = %s, '
+                'unique_checks = %s, bulk_insert_buffer_size = %s',
+                (previous['foreignKeyChecks'], previous['uniqueChecks'],
+                    previous['bulkInsertBufferSize']))
+
+
+def importTables(db, tables, ignoreConflicts=False, loadDataInfile=False,
+        chunkSize=IMPORT_CHUNK_SIZE, bulkLoad=False):
+    '''
+    Import tables (dicts with "name" and "rows") over one connection. With
+    bulkLoad, per-row checks are relaxed for the session and MyISAM tables
+    build their non-unique indexes once after loading.
+    '''
+    with closing(db.cursor()) as cursor:
+        importRows = insertRows
+        if loadDataInfile:
+            cursor.execute('SELECT @@local_infile AS enabled')
+            if cursor.fetchone()['enabled']:
+                importRows = loadRows
+            else:
+                logger.warning('LOAD DATA LOCAL INFILE is disabled on ' +
+                        'the server, using INSERT statements instead.')
 
-    return database
+        # Unique checks are needed to detect conflicts to ignore
+        if bulkLoad:
+            session = bulkLoadSession(cursor, uniqueChecks=ignoreConflicts)
+        else:
+            session = nullcontext()
+
+        with session:
+            for table in tables:
+                logger.info('Installing table %s', table['name'])
+
+                # Rebuild non-unique indexes once after loading instead of
+                # per row (only MyISAM supports this)
+                disableKeys = bulkLoad and \
+                        getTableEngine(cursor, table['name']) == 'MyISAM'
+                if disableKeys:
+                    cursor.execute('ALTER TABLE ' +
+                            quoteIdentifier(table['name']) + ' DISABLE KEYS')
+                try:
+                    importRows(db, cursor, table['name'], table['rows'],
+                            ignoreConflicts, chunkSize)
+                finally:
+                    if disableKeys:
+                        cursor.execute('ALTER TABLE ' +
+                                quoteIdentifier(table['name']) +
+                                ' ENABLE KEYS')
+
+
+def getTableEngine(cursor, tableName):
+    '''
+    Get the storage engine of a table in the current database, or None if
+    the table doesn't exist.
+    '''
+    cursor.execute('SELECT ENGINE AS engine FROM information_schema.tables '
+            'WHERE table_schema = DATABASE() AND table_name = %s',
+            (tableName,))
+    row = cursor.fetchone()
+    return row['engine'] if row else None
 
 
 class SchemaVersionMismatch(Exception):
     pass
 
 
+class SchemaVersionNotFound(Exception):
+    pass
+
+
+def readSchemaVersion(database, metadataTableName='metadata'):
+    '''
+    Read the installed database schema version from the metadata table.
+    Returns None if no schema is installed.
+    '''
+    # A plain cursor avoids building a dict for a single value
+    with closing(database.cursor(Cursor)) as cursor:
+        try:
+            cursor.execute('SELECT value FROM ' +
+                    quoteIdentifier(metadataTableName) +
+                    ' WHERE attribute = %s LIMIT 1', ('version',))
+        except pymysql.ProgrammingError as e:
+            # 1146 == table does not exist
+            if e.args[0] == 1146:
+                # Version 1 tables don't exist either, so it is most
+                # likely that no schema is installed
+                return None
+            else:
+                raise
+        row = cursor.fetchone()
+
+    if not row:
+        raise SchemaVersionNotFound('Could not read current database version')
+
+    return row[0]
+
+
 class AppPlugin(AppPluginBase):
     context = None
     backupProcess = None
@@ -76,7 +609,8 @@ class AppPlugin(AppPluginBase):
             while True:
                 try:
                     attempt += 1
-                    context['database'] = getMysqlConnection(context)
+                    context['database'] = pymysql.connect(
+                            **getMysqlConnectArgs(context))
                 except pymysql.OperationalError:
                     if attempt == 10:
                         raise 
@@ -125,17 +659,27 @@ class AppPlugin(AppPluginBase):
             logger.info('Backing up MySQL database %s to Amazon S3.',
                     self.context['mysqlDbName'])
             backupFilePath = None
+            optionFilePath = None
             try:
                 backupFileName = '{}-{}.sql'.format(self.context['mysqlDbName'],
                         str(datetime.utcnow()))
                 backupFilePath = '/tmp/' + backupFileName
-                cmd = 'mysqldump --host={} --user={} --password="{}" {} > "{}"'.format(
-                    self.context['mysqlHost'],
-                    self.context['mysqlUser'],
-                    self.context['mysqlPassword'],
-                    self.context['mysqlDbName'],
-                    backupFilePath)
-                subprocess.check_call(cmd, shell=True)
+                # Pass the password in an option file that only this user
+                # can read (mkstemp creates it with mode 0600) so it doesn't
+                # show up in the process list or environment
+                password = (self.context['mysqlPassword'] or '') \
+                        .replace('\\', '\\\\').replace('"', '\\"')
+                fd, optionFilePath = tempfile.mkstemp(suffix='.cnf')
+                with os.fdopen(fd, 'w') as optionFile:
+                    optionFile.write(
+                            '[client]\npassword="{}"\n'.format(password))
+                with open(backupFilePath, 'wb') as backupFile:
+                    subprocess.check_call(['mysqldump',
+                        '--defaults-extra-file=' + optionFilePath,
+                        '--host=' + self.context['mysqlHost'],
+                        '--port=' + str(self.context['mysqlPort']),
+                        '--user=' + self.context['mysqlUser'],
+                        self.context['mysqlDbName']], stdout=backupFile)
                 if self.context['mysqlBackupS3KeyPrefix']:
                     key = '{}/{}'.format(self.context['mysqlBackupS3KeyPrefix'],
                             backupFileName)
@@ -155,6 +699,11 @@ class AppPlugin(AppPluginBase):
                         os.remove(backupFilePath)
                     except:
                         logger.error('Error removing MySQL dump file.')
+                if optionFilePath:
+                    try:
+                        os.remove(optionFilePath)
+                    except:
+                        logger.error('Error removing MySQL option file.')
 
             time.sleep(self.context['mysqlBackupIntervalSecs'])
 
@@ -163,35 +712,22 @@ class AppPlugin(AppPluginBase):
         '''
         Get currently installed database schema version.
         '''
-        currentVersion = None
-        with closing(self.context['database'].cursor()) as cursor:
-            try:
-                cursor.execute('SELECT * FROM metadata WHERE attribute = %s',
-                        ('version',))
-            except pymysql.ProgrammingError as e:
-                # 1146 == table does not exist
-                if e.args[0] == 1146:
-                    # Version 1 tables don't exist either, so it is most
-                    # likely that no schema is installed
-                    return None
-                else:
-                    raise
-            else:
-                row = cursor.fetchone()
-                if not row:
-                    raise DatabaseError('Could not read current ' +
-                        'database version')
-                currentVersion = row['value']
-
-        return currentVersion
+        return readSchemaVersion(self.context['database'])
 
 
     def checkDbSchemaVersion(self):
-        currentVersion = self.getCurrDbSchemaVersion()
-
         # Get most recent version from context
         expectedVersion = self.context['mysqlSchemaPackage'].versions[-1]
 
+        # Skip the database read if the deployment declares that the
+        # expected version is installed
+        knownVersion = os.environ.get('MYSQL_PLUGIN_KNOWN_VERSION')
+        if knownVersion is not None and \
+                knownVersion == str(expectedVersion):
+            return
+
+        currentVersion = self.getCurrDbSchemaVersion()
+
         if currentVersion != expectedVersion:
             raise SchemaVersionMismatch(
                 ('Installed database schema version {} does '
@@ -202,6 +738,7 @@ class AppPlugin(AppPluginBase):
 
 class CommandLinePlugin(CLPluginBase):
     context = None
+    versionModuleNames = None
 
     def getConfig(self):
         return \
@@ -226,21 +763,78 @@ class CommandLinePlugin(CLPluginBase):
         self.context = context
 
 
+    def getVersionModule(self, version):
+        '''
+        Get the schema package's module for the given version, importing it
+        on first use.
+        '''
+        moduleName = self.getVersionModuleNames().get(str(version))
+        if moduleName is None:
+            raise CommandError('Unknown schema version ' + str(version))
+        return importVersionModule(moduleName)
+
+
+    def getVersionModuleNames(self):
+        '''
+        Get a mapping from each version listed in the schema package's
+        "versions" to the name of its module. Built once, so resolving a
+        version never searches the package for modules that don't exist.
+        '''
+        if self.versionModuleNames is None:
+            package = self.context['mysqlSchemaPackage']
+            self.versionModuleNames = {str(version):
+                    package.__name__ + '.v' + str(version)
+                    for version in package.versions}
+        return self.versionModuleNames
+
+
+    @contextmanager
+    def openDatabase(self):
+        '''
+        Use the context's shared database connection if there is one,
+        otherwise a new connection that is closed afterwards.
+        '''
+        db = self.context.get('database')
+        if db is not None:
+            yield db
+        else:
+            with closing(pymysql.connect(
+                    **getMysqlConnectArgs(self.context))) as db:
+                yield db
+
+
+    def getMigrationContext(self, db):
+        '''
+        Build the context passed to a schema version's migration functions.
+        '''
+        context = self.context.copy()
+        context['database'] = db
+        context['getStreamingConnection'] = partial(getStreamingConnection,
+                self.context)
+        context['batchedFetch'] = batchedFetch
+        return context
+
+
     def execute(self, sqlFilePath):
         '''
         Execute the SQL file at the given path.
         '''
-        context = self.context
+        with closing(pymysql.connect(**getMysqlConnectArgs(self.context,
+                client_flag=CLIENT.MULTI_STATEMENTS))) as db:
+            self.executeFile(db, sqlFilePath)
 
-        logger.info('Executing SQL from file %s...', (sqlFilePath,))
 
-        cmd = 'mysql --host=%s --user=%s --password="%s" %s < %s' \
-                % (context['mysqlHost'], context['mysqlUser'],
-                        context['mysqlPassword'], context['mysqlDbName'],
-                        sqlFilePath)
-        subprocess.check_call(cmd, shell=True)
+    def executeFile(self, db, sqlFilePath):
+        '''
+        Execute the SQL file at the given path on a connection that has
+        multiple statements enabled.
+        '''
+        logger.info('Executing SQL from file %s...', sqlFilePath)
 
-        logger.info('Executed file ' + sqlFilePath + ' successfully.')
+        with open(sqlFilePath, encoding='utf-8') as f:
+            executeSqlScript(db, f)
+
+        logger.info('Executed file %s successfully.', sqlFilePath)
 
 
     @argh.arg('-l', '--logLevel', 
@@ -254,90 +848,146 @@ class CommandLinePlugin(CLPluginBase):
 
         Warning: this will wipe out any existing database!
         '''
-        logging.basicConfig(level=getattr(logging, logLevel.upper(),
-            logging.NOTSET), format=logFormat)
+        configureLogging(logLevel, logFormat)
         context = self.context
 
-        # Drop database if exists
-        cmd = 'mysql --host=%s --user=%s --password="%s" \
-                --execute="DROP DATABASE IF EXISTS \\`%s\\`"' \
-                % (context['mysqlHost'], context['mysqlUser'],
-                        context['mysqlPassword'], context['mysqlDbName'])
-        subprocess.check_call(cmd, shell=True)
+        dbName = quoteIdentifier(context['mysqlDbName'])
 
-        logger.info('Creating database...')
+        # Connect without selecting a database since it may not exist yet,
+        # and do all the work on this one connection
+        with closing(pymysql.connect(**getMysqlConnectArgs(context, db=None,
+                client_flag=CLIENT.MULTI_STATEMENTS))) as db:
+            logger.info('Creating database...')
 
-        # Create database
-        cmd = 'mysql --host=%s --user=%s --password="%s" \
-                --execute="CREATE DATABASE \\`%s\\`"' \
-                % (context['mysqlHost'], context['mysqlUser'], context['mysqlPassword'],
-                        context['mysqlDbName'])
-        subprocess.check_call(cmd, shell=True)
+            # Drop database if exists, then create it
+            executeSqlScript(db, 'DROP DATABASE IF EXISTS {0}; '
+                    'CREATE DATABASE {0}; USE {0};'.format(dbName))
 
-        return self.execute(context['mySchemaFilePath'])
+            self.executeFile(db, context['mySchemaFilePath'])
 
 
+    @argh.arg('--loadDataInfile', 
+            help='load tables with LOAD DATA LOCAL INFILE if the server '
+                 'allows it (faster for large data files)')
+    @argh.arg('--bulkLoad', 
+            help='relax foreign key and unique checks and defer MyISAM '
+                 'index builds while loading (data must be consistent)')
+    @argh.arg('--batchSize', type=int,
+            help='rows per statement and transaction')
+    @argh.arg('-w', '--workers', type=int,
+            help='number of tables to load concurrently')
     @argh.arg('-l', '--logLevel', 
             help='one of "debug", "info", "warning", "error", and "critical"')
     @argh.arg('--logFormat', 
             help='Python-like log format (see Python docs for details)')
     def importData(self, jsonDataFilePath, ignoreConflicts=False,
-            logLevel='warning',
+            loadDataInfile=False, bulkLoad=False,
+            batchSize=IMPORT_CHUNK_SIZE, workers=1, logLevel='warning',
             logFormat='%(levelname)s:%(name)s (at %(asctime)s): %(message)s'):
-        logging.basicConfig(level=getattr(logging, logLevel.upper(),
-            logging.NOTSET), format=logFormat)
+        '''
+        Import table rows from a JSON data file.
 
-        # Get a database connection
-        db = getMysqlConnection(self.context)
+        With --ignoreConflicts, rows whose keys already exist are skipped.
+        With --loadDataInfile, the server also converts invalid values (e.g.
+        over-long strings) with a warning instead of failing, as it always
+        does for LOAD DATA LOCAL.
 
-        # Load data file
-        tables = json.load(open(jsonDataFilePath, encoding='utf-8'))
+        With --bulkLoad, foreign key checks are off during the import, and
+        so are unique checks unless conflicts are being ignored, so the data
+        must be consistent.
+        '''
+        configureLogging(logLevel, logFormat)
+
+        if batchSize < 1:
+            raise CommandError('Batch size must be at least 1')
+
+        if workers < 1:
+            raise CommandError('Number of workers must be at least 1')
+
+        # Tables load out of order with several workers, so child rows may
+        # arrive before their parents
+        if workers > 1 and not bulkLoad:
+            raise CommandError('Loading with more than one worker '
+                    'requires --bulkLoad')
+
+        def connect(shared=False):
+            # Local infile is only enabled on dedicated connections
+            if loadDataInfile:
+                return closing(pymysql.connect(**getMysqlConnectArgs(
+                        self.context, local_infile=True)))
+            elif shared:
+                return self.openDatabase()
+            return closing(getMysqlConnection(self.context))
+
+        importArgs = dict(ignoreConflicts=ignoreConflicts,
+                loadDataInfile=loadDataInfile, chunkSize=batchSize,
+                bulkLoad=bulkLoad)
+
+        # Don't ask the pool for more connections than it allows; zero or
+        # None means it is unlimited
+        maxConnections = self.context['mysqlPoolMaxConnections']
+        if not loadDataInfile and isinstance(maxConnections, int) and \
+                maxConnections > 0:
+            workers = min(workers, maxConnections)
+
+        if workers <= 1:
+            with connect(shared=True) as db:
+                importTables(db, iterDataFileTables(jsonDataFilePath),
+                        **importArgs)
+            return
+
+        # Load tables concurrently, each worker on its own connection. The
+        # file is still read in order, with at most one table per worker
+        # waiting in memory.
+        tableQueue = queue.Queue(maxsize=workers)
+        failed = threading.Event()
+
+        def work():
+            tables = iter(tableQueue.get, None)
+            try:
+                with connect() as db:
+                    importTables(db, tables, **importArgs)
+            except:
+                failed.set()
+                # Keep taking tables so the reader never blocks on a failed
+                # worker
+                for _ in tables:
+                    pass
+                raise
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(work) for _ in range(workers)]
+            try:
+                for table in iterDataFileTables(jsonDataFilePath):
+                    if failed.is_set():
+                        break
+                    table['rows'] = list(table['rows'])
+                    tableQueue.put(table)
+            finally:
+                for _ in futures:
+                    tableQueue.put(None)
 
-        # Import
-        for table in tables:
-            logger.info('Installing table %s', table['name'])
-            for row in table['rows']:
-                query = 'INSERT INTO ' + table['name'] + ' (' \
-                        + ','.join(row.keys()) \
-                        + ') VALUES (' + '%s' + ',%s' * (len(row) -1) + ')'
-                with closing(db.cursor()) as cursor:
-                    try:
-                        cursor.execute(query, tuple(row.values()))
-                    except pymysql.IntegrityError:
-                        if ignoreConflicts:
-                            logger.info('Ignoring conflict in table %s',
-                                    table['name'])
-                            continue
-                        else:
-                            raise
+            for future in futures:
+                future.result()
 
 
     def getSchemaVersion(self, metadataTableName='metadata'):
         '''
         Get currently installed database schema version.
         '''
-        currentVersion = None
-        with closing(getMysqlConnection(self.context)) as db:
-            with closing(db.cursor()) as cursor:
-                try:
-                    cursor.execute('SELECT * FROM ' + metadataTableName + \
-                            ' WHERE attribute = %s', ('version',))
-                except pymysql.ProgrammingError as e:
-                    # 1146 == table does not exist
-                    if e.args[0] == 1146:
-                        # Version 1 tables don't exist either, so it is most
-                        # likely that no schema is installed
-                        return None
-                    else:
-                        raise
-                else:
-                    row = cursor.fetchone()
-                    if not row:
-                        raise CommandError('Could not read current ' +
-                            'database version')
-                    currentVersion = row['value']
+        with self.openDatabase() as db:
+            return self.readCurrentVersion(db, metadataTableName)
 
-        return currentVersion
+
+    def readCurrentVersion(self, db, metadataTableName='metadata'):
+        '''
+        Get currently installed database schema version using the given
+        connection.
+        '''
+        try:
+            return readSchemaVersion(db, metadataTableName)
+        except SchemaVersionNotFound as e:
+            raise CommandError(str(e))
 
 
     @argh.arg('-t', '--targetVersion', 
@@ -357,41 +1007,38 @@ class CommandLinePlugin(CLPluginBase):
 
         This will call the application's target version's upgrade function. 
         '''
-        logging.basicConfig(level=getattr(logging, logLevel.upper(),
-            logging.NOTSET), format=logFormat)
-
-        currentVersion = self.getSchemaVersion()
-
-        if currentVersion is None:
-            raise CommandError('It seems there is no schema ' +
-                'currently installed. You can install a schema with ' +
-                'the "install" command.')
-        elif currentVersion == targetVersion:
-            raise CommandError('Schema version ' + currentVersion 
-                    + ' is already installed')
-
-        logger.info('Current schema version = %s', currentVersion)
+        configureLogging(logLevel, logFormat)
 
         # Default target version is the latest one available
         if targetVersion is None:
             targetVersion = self.context['mysqlSchemaPackage'].versions[-1]
 
-        # Get module for target version
-        targetVersMod = importlib.import_module(
-                self.context['mysqlSchemaPackage'].__name__ + '.v' +
-                str(targetVersion))
-
-        # Make sure it has an upgrade function
-        if not hasattr(targetVersMod, 'upgrade'):
-            raise CommandError('Version ' + targetVersion +
-                    ' does not support ' +
-                    'the upgrade operation (hint: overlay and trim ' +
-                    'may be supported).')
-
-        # Delegate to appropriate upgrade function
-        with closing(getMysqlConnection(self.context)) as db:
-            context = self.context.copy()
-            context['database'] = db
+        # Use one connection for the version check and the upgrade
+        with self.openDatabase() as db:
+            currentVersion = self.readCurrentVersion(db)
+
+            if currentVersion is None:
+                raise CommandError('It seems there is no schema ' +
+                    'currently installed. You can install a schema with ' +
+                    'the "installSchema" command.')
+            elif str(currentVersion) == str(targetVersion):
+                raise CommandError('Schema version ' + str(currentVersion)
+                        + ' is already installed')
+
+            logger.info('Current schema version = %s', currentVersion)
+
+            # Get module for target version
+            targetVersMod = self.getVersionModule(targetVersion)
+
+            # Make sure it has an upgrade function
+            if not hasattr(targetVersMod, 'upgrade'):
+                raise CommandError('Version ' + str(targetVersion) +
+                        ' does not support ' +
+                        'the upgrade operation (hint: overlay and trim ' +
+                        'may be supported).')
+
+            # Delegate to appropriate upgrade function
+            context = self.getMigrationContext(db)
             targetVersMod.upgrade(context, fromVersion=currentVersion)
 
 
@@ -417,51 +1064,51 @@ class CommandLinePlugin(CLPluginBase):
 
         This will call the application's target version's overlay function. 
         '''
-        logging.basicConfig(level=getattr(logging, logLevel.upper(),
-            logging.NOTSET), format=logFormat)
-
-        currentVersion = self.getSchemaVersion()
-
-        if currentVersion is None:
-            raise CommandError('It seems there is no schema ' +
-                'currently installed. You can install a schema with ' +
-                'the "install" command.')
-        elif currentVersion == targetVersion:
-            raise CommandError('Schema version ' + currentVersion 
-                    + ' is already installed')
-
-        logger.info('Current schema version = %s', currentVersion)
+        configureLogging(logLevel, logFormat)
 
         # Default target version is the latest one available
         if targetVersion is None:
             targetVersion = self.context['mysqlSchemaPackage'].versions[-1]
 
-        # Get module for target version
-        targetVersMod = importlib.import_module(
-                self.context['mysqlSchemaPackage'].__name__ + '.v' +
-                str(targetVersion))
+        # Use one connection for the version check and the overlay
+        with self.openDatabase() as db:
+            currentVersion = self.readCurrentVersion(db)
+
+            if currentVersion is None:
+                raise CommandError('It seems there is no schema ' +
+                    'currently installed. You can install a schema with ' +
+                    'the "installSchema" command.')
+            elif str(currentVersion) == str(targetVersion):
+                raise CommandError('Schema version ' + str(currentVersion)
+                        + ' is already installed')
+
+            logger.info('Current schema version = %s', currentVersion)
+
+            # Get module for target version
+            targetVersMod = self.getVersionModule(targetVersion)
 
-        # Make sure it has an overlay function
-        if not hasattr(targetVersMod, 'overlay'):
-            raise CommandError('Version ' + targetVersion +
-                    ' does support the overlay operation.')
+            # Make sure it has an overlay function
+            if not hasattr(targetVersMod, 'overlay'):
+                raise CommandError('Version ' + str(targetVersion) +
+                        ' does not support the overlay operation.')
 
-        # Delegate to appropriate upgrade function
-        with closing(getMysqlConnection(self.context)) as db:
-            context = self.context.copy()
-            context['database'] = db
-            targetVersMod.overlay(context, fromVersion=currentVersion, **kwargs)
+            # Delegate to appropriate overlay function
+            context = self.getMigrationContext(db)
+            targetVersMod.overlay(context, fromVersion=currentVersion,
+                    **kwargs)
 
 
     @argh.arg('-r', '--referenceVersion', 
             help='reference version for trim operation')
     @argh.arg('-t', '--trimVersion', 
             help='version that is now obsolete')
+    @argh.arg('-y', '--yes', 
+            help='skip confirmation (for unattended migrations)')
     @argh.arg('-l', '--logLevel', 
             help='one of "debug", "info", "warning", "error", and "critical"')
     @argh.arg('--logFormat', 
             help='Python-like log format (see Python docs for details)')
-    def trim(self, referenceVersion=None, trimVersion=None,
+    def trim(self, referenceVersion=None, trimVersion=None, yes=False,
             logLevel='warning', 
             logFormat='%(levelname)s:%(name)s (at %(asctime)s): %(message)s'):
         '''
@@ -474,8 +1121,7 @@ class CommandLinePlugin(CLPluginBase):
         no reference version is specified, this will trim with reference to the
         currently installed schema version.
         '''
-        logging.basicConfig(level=getattr(logging, logLevel.upper(),
-            logging.NOTSET), format=logFormat)
+        configureLogging(logLevel, logFormat)
 
         if referenceVersion is None:
             referenceVersion = self.getSchemaVersion()
@@ -485,13 +1131,12 @@ class CommandLinePlugin(CLPluginBase):
                 'currently installed.')
 
         # Get module for reference version
-        refVersMod = importlib.import_module(
-                self.context['mysqlSchemaPackage'].__name__ + '.v' + \
-                        str(referenceVersion))
+        refVersMod = self.getVersionModule(referenceVersion)
 
         # Make sure it has a trim function
         if not hasattr(refVersMod, 'trim'):
-            raise CommandError('Version ' + referenceVersion + ' does not ' +
+            raise CommandError('Version ' + str(referenceVersion) +
+                ' does not ' +
                 'support the trim operation.')
 
         # Set default trim version
@@ -499,22 +1144,41 @@ class CommandLinePlugin(CLPluginBase):
             trimVersion = refVersMod.previousVersion
 
         # Confirm with user
-        response = askYesOrNoQuestion('Trim is a destructive and ' +
-            'irreversible operation. Are you sure you want to proceed?')
+        if yes:
+            response = 'y'
+        else:
+            response = askYesOrNoQuestion('Trim is a destructive and ' +
+                'irreversible operation. Are you sure you want to proceed?')
 
         if response == 'y':
             # Delegate to appropriate upgrade function
-            with closing(getMysqlConnection(self.context)) as db:
-                context = self.context.copy()
-                context['database'] = db
+            with self.openDatabase() as db:
+                context = self.getMigrationContext(db)
                 refVersMod.trim(context, trimVersion)
         else:
             logger.info('Trim not performed (whew!)')
 
 
 
+def configureLogging(logLevel, logFormat):
+    '''
+    Configure root logging for a command unless it is already configured.
+    '''
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=getattr(logging, logLevel.upper(),
+            logging.NOTSET), format=logFormat)
+
+
+@lru_cache(maxsize=None)
+def importVersionModule(moduleName):
+    '''
+    Import a schema version module, keeping it for later lookups.
+    '''
+    return importlib.import_module(moduleName)
+
+
 def askYesOrNoQuestion(question):
-    cfm = input(question + ' (y/n): ')
-    while cfm != 'y' and cfm != 'n':
-        cfm = input('Please type y or n: ')
+    cfm = input(question + ' (y/n): ').strip().lower()
+    while cfm not in YES_OR_NO:
+        cfm = input('Please type y or n: ').strip().lower()
     return cfm
@@ -8,6 +8,8 @@ setup(
     [
         'Coronado',
         'PyMySQL',
+        'DBUtils>=2.0',
+        'ijson',
         'argh'
     ],
     author='Mukul Majmudar',
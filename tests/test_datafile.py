@@ -0,0 +1,102 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import MySQLPlugin
+from MySQLPlugin import iterDataFileTables, formatTsvField
+
+
+class DataFileTest(unittest.TestCase):
+    '''
+    Tests for reading tables from JSON data files.
+    '''
+    def writeDataFile(self, tables):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(tables, f)
+        self.addCleanup(os.remove, path)
+        return path
+
+
+    def readTables(self, path, streamed=True):
+        '''
+        Read all tables from a data file, streaming it regardless of size
+        unless streamed is False.
+        '''
+        threshold = 0 if streamed else MySQLPlugin.JSON_STREAMING_THRESHOLD
+        with mock.patch.object(MySQLPlugin, 'JSON_STREAMING_THRESHOLD',
+                threshold):
+            return [dict(table, rows=list(table['rows']))
+                    for table in iterDataFileTables(path)]
+
+
+    def testRowsAfterName(self):
+        tables = [{'name': 'a', 'rows': [{'id': 1}, {'id': 2}]},
+                {'name': 'b', 'rows': []}]
+        path = self.writeDataFile(tables)
+        self.assertEqual(self.readTables(path), tables)
+        self.assertEqual(self.readTables(path, streamed=False), tables)
+
+
+    def testRowsBeforeName(self):
+        tables = [{'rows': [{'id': 1}], 'name': 'a'},
+                {'rows': [{'id': 2}], 'name': 'b', 'extra': True}]
+        path = self.writeDataFile(tables)
+        self.assertEqual(self.readTables(path), tables)
+
+
+    def testStreamedRowsAreLazy(self):
+        path = self.writeDataFile([{'name': 'a', 'rows': [{'id': 1}]}])
+        with mock.patch.object(MySQLPlugin, 'JSON_STREAMING_THRESHOLD', 0):
+            table = next(iterDataFileTables(path))
+            self.assertNotIsInstance(table['rows'], list)
+            self.assertEqual(list(table['rows']), [{'id': 1}])
+
+
+    def testPartiallyConsumedRows(self):
+        tables = [{'name': 'a', 'rows': [{'id': 1}, {'id': 2}, {'id': 3}]},
+                {'name': 'b', 'rows': [{'id': 4}], 'after': 'rows'}]
+        path = self.writeDataFile(tables)
+        with mock.patch.object(MySQLPlugin, 'JSON_STREAMING_THRESHOLD', 0):
+            names = []
+            for table in iterDataFileTables(path):
+                names.append(table['name'])
+                if table['name'] == 'a':
+                    self.assertEqual(next(table['rows']), {'id': 1})
+                else:
+                    self.assertEqual(list(table['rows']), [{'id': 4}])
+        self.assertEqual(names, ['a', 'b'])
+
+
+    def testNestedValues(self):
+        tables = [{'name': 'a', 'options': {'keys': [1, [2, 3]]},
+                'rows': [{'id': 1, 'data': {'tags': ['x', {'y': None}]},
+                    'list': [[], {}]}]},
+                {'meta': [{'rows': []}], 'rows': [{'id': 2}], 'name': 'b'}]
+        path = self.writeDataFile(tables)
+        self.assertEqual(self.readTables(path), tables)
+
+
+
+class TsvFieldTest(unittest.TestCase):
+    '''
+    Tests for formatting LOAD DATA fields.
+    '''
+    def testNull(self):
+        self.assertEqual(formatTsvField(None), '\\N')
+        self.assertEqual(formatTsvField('NULL'), 'NULL')
+
+
+    def testBooleans(self):
+        self.assertEqual(formatTsvField(True), '1')
+        self.assertEqual(formatTsvField(False), '0')
+        self.assertEqual(formatTsvField(0), '0')
+
+
+    def testEscapes(self):
+        self.assertEqual(formatTsvField('a\tb'), 'a\\tb')
+        self.assertEqual(formatTsvField('a\\b'), 'a\\\\b')
+        self.assertEqual(formatTsvField('a\nb\r\0'), 'a\\nb\\r\\0')
+        self.assertEqual(formatTsvField('\\N'), '\\\\N')
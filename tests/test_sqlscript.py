@@ -0,0 +1,82 @@
+import unittest
+
+from MySQLPlugin import iterSqlScriptBatches
+
+
+def splitScript(sql, batchSize=1):
+    return list(iterSqlScriptBatches(sql.splitlines(keepends=True),
+            batchSize))
+
+
+class SqlScriptTest(unittest.TestCase):
+    '''
+    Tests for splitting SQL scripts into batches.
+    '''
+    def testStatementsAreGrouped(self):
+        sql = 'CREATE TABLE a (id INT);\nINSERT INTO a VALUES (1);\n'
+        self.assertEqual(splitScript(sql, batchSize=1024),
+                [sql.strip()])
+        self.assertEqual(splitScript(sql), ['CREATE TABLE a (id INT);',
+                'INSERT INTO a VALUES (1);'])
+
+
+    def testUnterminatedLastStatement(self):
+        self.assertEqual(splitScript('SELECT 1;\nSELECT 2\n'),
+                ['SELECT 1;', 'SELECT 2'])
+
+
+    def testMultiLineLiterals(self):
+        sql = ("INSERT INTO a VALUES (1, 'first line;\nsecond line');\n"
+                'INSERT INTO a VALUES (2, "it\'s;\n\\";\n");\n'
+                "INSERT INTO a VALUES (3, 'it''s;\n');\n"
+                'SELECT `odd;\ncolumn` FROM a;\n')
+        self.assertEqual(splitScript(sql), [
+                "INSERT INTO a VALUES (1, 'first line;\nsecond line');",
+                'INSERT INTO a VALUES (2, "it\'s;\n\\";\n");',
+                "INSERT INTO a VALUES (3, 'it''s;\n');",
+                'SELECT `odd;\ncolumn` FROM a;'])
+
+
+    def testComments(self):
+        sql = ('-- leading; comment\nSELECT 1; -- note\n'
+                'SELECT /* inline;\nblock; */ 2;\n'
+                '# trailing\n/* trailing;\nblock */\n')
+        self.assertEqual(splitScript(sql), ['SELECT 1;',
+                'SELECT /* inline;\nblock; */ 2;'])
+        self.assertEqual(splitScript(sql, batchSize=1024), [
+                '-- leading; comment\nSELECT 1; -- note\n'
+                'SELECT /* inline;\nblock; */ 2;'])
+
+
+    def testExecutableComments(self):
+        sql = '/*!40101 SET NAMES utf8 */;\n/*!40101 SET @a = 1 */\n'
+        self.assertEqual(splitScript(sql, batchSize=1024),
+                [sql.strip()])
+
+
+    def testDelimiterBlocks(self):
+        sql = ('CREATE TABLE a (id INT);\n'
+                'DELIMITER //\n'
+                'CREATE PROCEDURE p()\nBEGIN\n'
+                "  SELECT '//';\n  SELECT 1;\nEND//\n"
+                'CREATE TRIGGER t BEFORE INSERT ON a\n'
+                'FOR EACH ROW SET NEW.id = 1// SELECT 2//\n'
+                'delimiter ;\n'
+                'SELECT 3;\n')
+        self.assertEqual(splitScript(sql, batchSize=1024), [
+                'CREATE TABLE a (id INT);',
+                "CREATE PROCEDURE p()\nBEGIN\n  SELECT '//';\n"
+                    '  SELECT 1;\nEND',
+                'CREATE TRIGGER t BEFORE INSERT ON a\n'
+                    'FOR EACH ROW SET NEW.id = 1',
+                'SELECT 2',
+                'SELECT 3;'])
+
+
+    def testDelimiterInsideStatement(self):
+        sql = ('CREATE TABLE a (\n  id INT,\n  delimiter CHAR(1) NOT NULL\n'
+                ');\nSELECT 1;\n')
+        self.assertEqual(splitScript(sql), [
+                'CREATE TABLE a (\n  id INT,\n  delimiter CHAR(1) NOT NULL\n'
+                    ');',
+                'SELECT 1;'])